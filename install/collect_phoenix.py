@@ -3,9 +3,41 @@
 fres = open('/data/phoenix_raw.txt', 'w')
 fres.write('bench type threads cycles instructions avxinstructions time\n')
 
+HEADER     = '--- Running '
+PERF_START = 'Performance counter stats for'
+PERF_END   = 'seconds time elapsed'
+
+
+def interesting_lines(log):
+    # perf stats are a tiny part of the log: jump between them with str.find
+    # and return only the last header line before each block and the block
+    pos = 0
+    while True:
+        start = log.find(PERF_START, pos)
+        if start == -1:
+            return
+
+        header = log.rfind('\n' + HEADER, max(pos - 1, 0), start)
+        if header != -1:
+            yield log[header + 1:log.find('\n', header + 1) + 1]
+        elif pos == 0 and log.startswith(HEADER):
+            yield log[:log.find('\n') + 1]
+
+        start = log.rfind('\n', 0, start) + 1
+        end = log.find(PERF_END, start)
+        end = log.find('\n', end) + 1 if end != -1 else 0
+        if end == 0:
+            # block is not finished or ends the log, take the rest of it
+            end = len(log)
+        for l in log[start:end].splitlines(True):
+            yield l
+        pos = end
+
 
 def collect(filename, suffix):
     with open(filename, 'r') as f:
+        log = f.read()
+
         prog_type   = 'DUMMY'
         benchmark   = 'DUMMY'
         num_threads = 0
@@ -18,15 +50,15 @@ def collect(filename, suffix):
 
         isPerf = False
 
-        lines = f.readlines()
-        for l in lines:
-            if l.startswith('--- Running '):
-                benchmark   = l.split('--- Running ')[1].split(' ')[0]
-                num_threads = int(l.split('--- Running ')[1].split(' ')[1])
-                prog_type   = l.split('--- Running ')[1].split(' ')[2]
+        rows = []
+        for l in interesting_lines(log):
+            if l.startswith(HEADER):
+                benchmark   = l.split(HEADER)[1].split(' ')[0]
+                num_threads = int(l.split(HEADER)[1].split(' ')[1])
+                prog_type   = l.split(HEADER)[1].split(' ')[2]
                 continue
 
-            if "Performance counter stats for" in l:
+            if PERF_START in l:
                 isPerf = True
                 continue
 
@@ -40,14 +72,16 @@ def collect(filename, suffix):
                 avxinstructions = int(l.split()[0].replace('.', ''))
                 continue
 
-            if isPerf and "seconds time elapsed" in l:
+            if isPerf and PERF_END in l:
                 time = float(l.split()[0].replace(',', '.'))
                 isPerf = False
 
                 benchmark += suffix
-                fres.write('%s %s %d %d %d %d %f\n' %
+                rows.append('%s %s %d %d %d %d %f\n' %
                     (benchmark, prog_type, num_threads, cycles, instructions, avxinstructions, time))
                 continue
 
+        fres.writelines(rows)
+
 
 collect('/data/phoenix.log', '')
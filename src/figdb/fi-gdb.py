@@ -1,11 +1,16 @@
 from __future__ import print_function
 import argparse
+from array import array
+import multiprocessing
 import random
+import select
 import subprocess
 import os
 import signal
 import time
 import hashlib
+import mmap
+import pickle
 import shutil
 
 # ---------------------------- LOCAL PATHS ----------------------------------- #
@@ -26,8 +31,12 @@ else:
     LIMIT = int(os.environ.get('LIMIT'))
 
 TIMEOUT = 3600  # in seconds
+PORTTIMEOUT = 10  # max time to wait for SDE to open its debug port, in seconds
+
+DYNTRACE_REGSEP = b"|"
+HASH_BUFSIZE    = 1 << 20
+PIPE_BUFSIZE    = 1 << 16
 
-DYNTRACE_REGSEP = "|"
 
 LOGDIR    = "logs"
 FULLLOG   = "log.log"
@@ -37,21 +46,62 @@ GDBLOG    = "gdblog"
 
 DEBUGPORT = 10000
 
+# number of fault injection runs executed in parallel (each in its own workdir)
+JOBS = 1
+WORKDIR = "."
+
+# (dynamic trace is read as bytes, so all names to look for in it are bytes)
+
 # not all GP registers are supported:
 #   - we do not inject into rflags, rsp and rip, these are considered control-flow
-SUPPORTED_GP_REGS = ["rax", "rbx", "rcx", "rdx", "rsi", "rdi", "rbp",
-                  "r8", "r9", "r10", "r11", "r12", "r13", "r14", "r15"]
+SUPPORTED_GP_REGS = frozenset([b"rax", b"rbx", b"rcx", b"rdx", b"rsi", b"rdi", b"rbp",
+                  b"r8", b"r9", b"r10", b"r11", b"r12", b"r13", b"r14", b"r15"])
 
 # instructions that must be definitely ignored (control-flow instructions)
-IGNORED_INSTS = ["pop", "push", "ret", "call", "cmp"]
+IGNORED_INSTS = frozenset([b"pop", b"push", b"ret", b"call", b"cmp"])
 
 # name for Intel RTM in dynamic trace produced by Intel SDE
-RTM_TYPE_NAME = "RTM"
+RTM_TYPE_NAME = b"RTM"
 # name for common x86 instrs in dynamic trace produced by Intel SDE
-BASE_TYPE_NAME = "BASE"
-
-XBEGIN_NAME = "xbegin"
-XEND_NAME   = "xtest"
+BASE_TYPE_NAME = b"BASE"
+
+XBEGIN_NAME = b"xbegin"
+XEND_NAME   = b"xtest"
+
+# thread id field of main thread
+MAIN_THREAD_ID = b"TID0:"
+
+
+# gdb script: set breakpoint on instr address, ignore it x times, then inject
+# fault in output register and detach
+GDBSCRIPT_TEMPLATE = ("target remote :%(port)d\n"
+                      "tb *0x%(addr)016x\n"
+                      "ignore 1 %(ignore)d\n"
+                      "commands 1\n"
+                      "%(inject)s"
+                      "  continue\n"
+                      "end\n"
+                      "continue\n"
+                      "p \"Going to detach...\"\n"
+                      "detach\n")
+
+INJECT_XMM    = ("  p $%(reg)s.uint128\n"
+                 "  set $%(reg)s.v2_int64[0] = $%(reg)s.v2_int64[0] ^ %(mask)d\n"
+                 "  p $%(reg)s.uint128\n")
+INJECT_YMM    = ("  p $%(reg)s.v2_int128\n"
+                 "  set $%(reg)s.v4_int64[0] = $%(reg)s.v4_int64[0] ^ %(mask)d\n"
+                 "  p $%(reg)s.v2_int128\n")
+INJECT_RFLAGS = ("  p $eflags\n"
+                 "  set $eflags = $eflags ^ 0xC5\n"    # flip CF, PF, ZF, and SF
+                 "  p $eflags\n")
+INJECT_GP     = ("  p $%(reg)s\n"
+                 "  set $%(reg)s = (long long) $%(reg)s ^ %(mask)d\n"
+                 "  p $%(reg)s\n")
+
+# first 3 chars of register name -> template, all other regs use INJECT_GP
+INJECT_TEMPLATES = {"xmm": INJECT_XMM,
+                    "ymm": INJECT_YMM,
+                    "rfl": INJECT_RFLAGS}
 
 
 # ---------------------------- GLOBALS --------------------------------------- #
@@ -59,55 +109,267 @@ XEND_NAME   = "xtest"
 # instr address -> [total number of invocations, output reg, next instr address]
 insts = {}
 
+# the same table packed into parallel arrays (struct of arrays) after parsing,
+# without instr addresses (faults go to successors); successor addresses are
+# stored as ints ("L" is 64 bit on x86-64 Linux), 0 is unknown
+inst_invocs     = array("L")
+inst_regs       = []
+inst_next_addrs = array("L")
+
 # reference output for this program
 ref_output = ""
 # file with binary output written by the program; compare using md5
 binary_output = ""
 
+# full log, open (line-buffered, append mode) for the whole campaign
+fulllog = None
+# serializes appends to the full log across worker processes
+log_lock = None
+
+# number of tmp folders of this worker that were handed over for deletion
+num_removed_tmps = 0
+# processes deleting these tmp folders
+removers = []
+
 # ------------------------------- HELPERS ------------------------------------ #
-def run2(args1, args2, timeout = TIMEOUT):
-    class Alarm(Exception):
-        pass
+def isPortListening(port):
+    # look up the socket in kernel tables instead of connecting to it:
+    # SDE serves only one debugger connection, a probe would steal it
+    local_port = ":%04X" % port
+    for table in ["/proc/net/tcp", "/proc/net/tcp6"]:
+        try:
+            with open(table, "r") as f:
+                f.readline()    # skip header
+                for line in f:
+                    fields = line.split()
+                    # fields[1] is local "address:port", state 0A is LISTEN
+                    if fields[1].endswith(local_port) and fields[3] == "0A":
+                        return True
+        except IOError:
+            pass
+    return False
+
+
+def freePort(port, step):
+    # first port of port, port + step, ... nobody listens on; a port taken
+    # by another program would make gdb attach to it instead of to our SDE
+    while isPortListening(port):
+        port += step
+    return port
+
+
+def waitForPort(port, process, timeout = PORTTIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if isPortListening(port):
+            return True
+        if process.poll() is not None:
+            # process died before opening the port, gdb will fail anyway
+            return False
+        time.sleep(0.02)
+    return False
+
+
+def waitProcess(process, deadline):
+    # process.wait() which gives up at deadline (as time.time()); returns
+    # False if process is still running then
+    delay = 0.001
+    while process.poll() is None:
+        if time.time() >= deadline:
+            return False
+        time.sleep(delay)
+        delay = min(2 * delay, 0.02)
+    return True
+
+
+def drainPipes(pipes, timeout, consumers = None):
+    # read all pipes concurrently until EOF, so that no process blocks on a
+    # full pipe; returns None if timeout (in seconds, -1 is none) expires;
+    # output of pipes in consumers (pipe -> function) is handed over to them
+    # chunk by chunk instead of being collected
+    consumers = consumers or {}
+    chunks = dict((pipe.fileno(), []) for pipe in pipes)
+    sinks = dict((pipe.fileno(), consumers.get(pipe, chunks[pipe.fileno()].append))
+                 for pipe in pipes)
+    poller = select.poll()
+    for fd in chunks:
+        poller.register(fd, select.POLLIN)
+
+    deadline = time.time() + timeout
+    num_open = len(pipes)
+    while num_open > 0:
+        if timeout == -1:
+            events = poller.poll()
+        else:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            events = poller.poll(remaining * 1000)
+
+        for (fd, _) in events:
+            chunk = os.read(fd, PIPE_BUFSIZE)
+            if chunk:
+                sinks[fd](chunk)
+            else:
+                # EOF (POLLHUP also ends up here)
+                poller.unregister(fd)
+                num_open -= 1
 
-    def alarm_handler(signum, frame):
-        raise Alarm
+    return [b"".join(chunks[pipe.fileno()]) for pipe in pipes]
 
+
+def run2(args1, args2, timeout = TIMEOUT, cwd = None, matcher = None, match_stderr = False):
     if DUMPINFO:
         print(args1)
         print(args2)
 
     p1 = subprocess.Popen(args1, shell = True
+            , cwd = cwd
             , stdout = subprocess.PIPE
             , stderr = subprocess.PIPE
             , preexec_fn = os.setsid)
 
-    # wait a bit until first process is loaded
-    time.sleep(2)
+    # wait until first process is loaded and listens for the debugger
+    waitForPort(DEBUGPORT, p1)
 
     p2 = subprocess.Popen(args2, shell = True
+            , cwd = cwd
             , stdout = subprocess.PIPE
             , stderr = subprocess.PIPE
             , preexec_fn = os.setsid)
 
-    signal.signal(signal.SIGALRM, alarm_handler)
-    signal.alarm(timeout)
-
-    try:
-        stdout2, stderr2 = p2.communicate()
-        stdout1, stderr1 = p1.communicate()
-        if timeout != -1:
-            signal.alarm(0)
-    except Alarm:
-        try:
-            os.killpg(p2.pid, signal.SIGKILL)
-            os.killpg(p1.pid, signal.SIGKILL)
-        except OSError:
-            pass
-        return -1, '', '', -1, '', ''
+    # stdout (or stderr) of first process is compared while being read
+    consumers = {}
+    if matcher is not None:
+        consumers[p1.stderr if match_stderr else p1.stdout] = matcher.feed
+
+    pipes = [p1.stdout, p1.stderr, p2.stdout, p2.stderr]
+    deadline = time.time() + timeout if timeout != -1 else float("inf")
+    outputs = drainPipes(pipes, timeout, consumers)
+    for pipe in pipes:
+        pipe.close()
+
+    # processes may keep running after closing their output, so wait for
+    # them until the same deadline
+    if outputs is None or not (waitProcess(p2, deadline) and waitProcess(p1, deadline)):
+        for p in [p2, p1]:
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                # process group is already gone
+                pass
+        p2.wait()
+        p1.wait()
+        return -1, b'', b'', -1, b'', b''
+
+    (stdout1, stderr1, stdout2, stderr2) = outputs
+    if matcher is not None:
+        matcher.finish()
+        if match_stderr: stderr1 = matcher
+        else:            stdout1 = matcher
     return p1.returncode, stdout1, stderr1, p2.returncode, stdout2, stderr2
 
 
-def initLog(ref_output, dynamic_trace_file, rtm_mode, program, args):
+def md5File(filename):
+    # hash file in chunks instead of reading it into one string
+    with open(filename, "rb") as f:
+        if hasattr(hashlib, "file_digest"):     # python >= 3.11
+            return hashlib.file_digest(f, "md5").hexdigest()
+        h = hashlib.md5()
+        for chunk in iter(lambda: f.read(HASH_BUFSIZE), b""):
+            h.update(chunk)
+        return h.hexdigest()
+
+
+def skipLines(output, numlines):
+    # offset of the first byte after numlines lines of output
+    offset = 0
+    for _ in range(numlines):
+        offset = output.find(b"\n", offset) + 1
+        if offset == 0:
+            return len(output)
+    return offset
+
+
+class OutputMatcher(object):
+    # compares output stream with ref output while it is read: header lines
+    # are skipped, the part equal to ref is not stored (it can be restored
+    # from ref), only output from first mismatch on is kept; so output of
+    # MASKED runs is never held in memory
+    def __init__(self, ref, numlines, marker = None):
+        self.ref = ref
+        self.numlines = numlines    # header lines still to skip
+        self.marker = marker        # if set, skip header only if it has marker
+        self.header = b""
+        self.matched = 0            # length of prefix of ref matched so far
+        self.rest = []              # output from first mismatch on
+
+    def feed(self, chunk):
+        while self.numlines > 0:
+            end = chunk.find(b"\n") + 1
+            if end == 0:
+                self.header += chunk
+                return
+            self.header += chunk[:end]
+            chunk = chunk[end:]
+            self.numlines -= 1
+            if self.numlines == 0:
+                self.endHeader()
+        self.compare(chunk)
+
+    def endHeader(self):
+        self.numlines = 0
+        if self.marker is not None and self.marker not in self.header:
+            # nothing to skip, header is part of output
+            header, self.header = self.header, b""
+            self.compare(header)
+        self.marker = None
+
+    def compare(self, data):
+        if self.rest or not self.ref.startswith(data, self.matched):
+            self.rest.append(data)
+        else:
+            self.matched += len(data)
+
+    def finish(self):
+        # at EOF, a header line to be checked for marker may lack newline
+        if self.marker is not None and self.header != b"":
+            self.endHeader()
+
+    def masked(self):
+        return (self.numlines == 0 and not self.rest and
+                self.matched == len(self.ref))
+
+    def parts(self):
+        return [self.header, self.ref[:self.matched]] + self.rest
+
+    # failed runs are classified by looking into their whole output
+    def startswith(self, prefix):
+        return b"".join(self.parts()).startswith(prefix)
+
+    def __contains__(self, s):
+        return s in b"".join(self.parts())
+
+
+def writeRunLog(logfile, retcode, stderr, stdout):
+    # outputs are bytes or OutputMatcher, write them piece by piece
+    with open(logfile, "wb") as f:
+        f.write(b"[return code: %d]\n\n---------- stderr ----------\n" % retcode)
+        for part in outputParts(stderr):
+            f.write(part)
+        f.write(b"\n\n---------- stdout ----------\n")
+        for part in outputParts(stdout):
+            f.write(part)
+        f.close()
+
+
+def outputParts(output):
+    if isinstance(output, OutputMatcher):
+        return output.parts()
+    return [output]
+
+
+def initLog(ref_output, dynamic_trace_file, rtm_mode, program, args, seed):
     full_log_file = "%s/%s" % (LOGDIR, FULLLOG)
     with open(full_log_file, "w") as f:
         f.write("----- info -----\n")
@@ -117,188 +379,276 @@ def initLog(ref_output, dynamic_trace_file, rtm_mode, program, args):
         f.write(" ref output: %s\n" % ref_output)
         f.write("  dyn trace: %s\n" % dynamic_trace_file)
         f.write("   rtm mode: %s\n" % rtm_mode)
+        f.write("       seed: %d\n" % seed)
         f.write("\n")
         f.write("----- log -----\n")
         f.close()
 
 
 # ------------------- IDENTIFY INSTRUCTIONS TO INJECT INTO ------------------- #
-def identifyInstsInOneThread(dynamic_trace_file, examine_thread_id):
-    insts_modified = False
-    in_rtm = False
-    last_inst_addr = "DUMMY"
-
-    with open(dynamic_trace_file, "r") as f:
-        for line in f:
-            if line.strip() == "":
-                continue
+def firstOperand(operands):
+    # e.g. "xmm1, xmm2" -> "xmm1"
+    return operands.split(None, 1)[0].split(b",", 1)[0]
+
+
+def regFromSSE(operands):
+    # only xmm regs are supported
+    reg_name = firstOperand(operands)
+    if reg_name.startswith(b"xmm") and not reg_name.startswith(b"xmmword"):
+        return reg_name
+    return None
+
+
+def regFromAVX(operands):
+    # only ymm regs are supported
+    reg_name = firstOperand(operands)
+    if reg_name.startswith(b"ymm") and not reg_name.startswith(b"ymmword"):
+        return reg_name
+    return None
+
+
+def regHandler(inst_type):
+    # which handler gets output register out of operands of an instr
+    # without DYNTRACE_REGSEP; None means all such instrs are ignored
+    if b"SSE" in inst_type:
+        return regFromSSE
+    if b"AVX" in inst_type:     # also covers "AVX2"
+        return regFromAVX
+    return None
 
-            inst_splitted = line.split()
-            assert(len(inst_splitted) >= 5)
-            assert(inst_splitted[1] == "INS")
 
-            # dissect parts of line
-            thread_id  = inst_splitted[0].replace("TID", "").replace(":", "")
+def identifyInsts(dyntrace_file):
+    # examine all threads in program in one pass over the trace,
+    # except TID0 (thread 0 is main thread which does not do real processing)
+    in_rtm = set()          # threads currently in RTM-covered code
+    last_inst = {}          # thread id -> entry in insts of last found instruction
+    examined_threads = set()
+
+    # instr category -> regHandler(category), filled on first occurrence
+    handlers = {}
+
+    # local aliases of globals used in the loop
+    insts_ = insts
+    ignored_insts = IGNORED_INSTS
+    supported_gp_regs = SUPPORTED_GP_REGS
+    regsep = DYNTRACE_REGSEP
+    main_thread_id = MAIN_THREAD_ID
+    rtm_type_name = RTM_TYPE_NAME
+    xbegin_name = XBEGIN_NAME
+    xend_name = XEND_NAME
+
+    with open(dyntrace_file, "rb") as f:
+        trace = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        # instrs found are only in RTM-covered code, and last found instr of
+        # a thread gets its successor before the thread leaves RTM; so while
+        # no thread is in RTM nothing but the next xbegin matters, and the
+        # lines until it are skipped without splitting them
+        skip = True
+        for line in iter(trace.readline, b""):
+            if skip:
+                pos = trace.find(xbegin_name, trace.tell() - len(line))
+                if pos < 0:
+                    break
+                pos = trace.rfind(b"\n", 0, pos) + 1
+                trace.seek(pos)
+                line = trace.readline()
+                skip = False
+
+            # e.g. "TID1: INS 0x0000000000400a3c BASE mov rax, rbx | rax = 0x1"
+            (instr_str, sep, regs_str) = line.partition(regsep)
+
+            # dissect parts of line, the 6th part are all the operands
+            inst_splitted = instr_str.split(None, 5)
+            if len(inst_splitted) < 5:
+                assert(line.strip() == b"")
+                continue
+            assert(inst_splitted[1] == b"INS")
+
+            thread_id  = inst_splitted[0]   # e.g. "TID1:"
             inst_addr  = inst_splitted[2]
             inst_type  = inst_splitted[3]   # category, e.g, "BASE" and "RTM"
             inst_name  = inst_splitted[4]   # mnemonic, e.g. "xor"
 
-            if int(thread_id) != examine_thread_id:
-                # we ignore what other threads do
+            if thread_id == main_thread_id:
                 continue
 
             # update last added to insts instruction with its successor
-            if last_inst_addr != "DUMMY":
-                insts[last_inst_addr][2] = inst_addr
-                last_inst_addr = "DUMMY"
-
-            if inst_type == RTM_TYPE_NAME:
-                if inst_name == XBEGIN_NAME: in_rtm = True
-                if inst_name == XEND_NAME:   in_rtm = False
+            prev_inst = last_inst.pop(thread_id, None)
+            if prev_inst is not None:
+                prev_inst[2] = inst_addr
+
+            if inst_type == rtm_type_name:
+                if inst_name == xbegin_name:
+                    in_rtm.add(thread_id)
+                if inst_name == xend_name:
+                    in_rtm.discard(thread_id)
+                    skip = not in_rtm
                 continue
 
-            if not in_rtm:
+            if thread_id not in in_rtm:
                 # instruction is not in RTM-covered portion of code, ignore
                 continue
 
-            if inst_name in IGNORED_INSTS:
+            if inst_name in ignored_insts:
                 continue
 
-            if DYNTRACE_REGSEP in line:
-                # --- get GP register
-                (_, regs_str) = line.split(DYNTRACE_REGSEP)
-                # get output register name
-                regs_str = regs_str.split(",")[0]   # leave only first reg
-                reg_name = regs_str.split("=")[0].strip()
+            if sep:
+                # --- get GP register, first one in e.g. " rax = 0x1, rflags = 0x2"
+                reg_name = regs_str.partition(b"=")[0].partition(b",")[0].strip()
                 # not all regs are supported
-                if reg_name not in SUPPORTED_GP_REGS:
-                    continue
-            elif "SSE" in inst_type:
-                # --- get SSE (xmm) register
-                if len(inst_splitted) < 6:
-                    continue
-                # get output register name
-                reg_name = inst_splitted[5].split(",")[0]
-                # only xmm regs are supported
-                if reg_name.startswith("xmmword"):
+                if reg_name not in supported_gp_regs:
                     continue
-                if not reg_name.startswith("xmm"):
-                    continue
-            elif "AVX" in inst_type or "AVX2" in inst_type:
-                # --- get AVX (ymm) register
+            else:
+                # --- get SSE (xmm) or AVX (ymm) register
                 if len(inst_splitted) < 6:
                     continue
-                # get output register name
-                reg_name = inst_splitted[5].split(",")[0]
-                # only ymm regs are supported
-                if reg_name.startswith("ymmword"):
+                handler = handlers.get(inst_type, False)
+                if handler is False:
+                    handler = handlers[inst_type] = regHandler(inst_type)
+                if handler is None:
+                    # --- all other instructions are ignored
                     continue
-                if not reg_name.startswith("ymm"):
+                reg_name = handler(inst_splitted[5])
+                if reg_name is None:
                     continue
-            else:
-                # --- all other instructions are ignored
-                continue
 
-            if inst_addr not in insts:
+            inst = insts_.get(inst_addr)
+            if inst is None:
                 # initialize new instruction
-                insts[inst_addr] = [1, reg_name, "DUMMY"]
+                inst = insts_[inst_addr] = [1, reg_name, "DUMMY"]
             else:
                 # increment number of invocations for existing instruction
-                insts[inst_addr][0] += 1
+                inst[0] += 1
 
-            insts_modified = True
-            last_inst_addr = inst_addr
-
-        f.close()
-    return insts_modified
-
-
-def identifyInsts(dyntrace_file):
-    # run identifyInstsInOneThread on all threads in program
-    # except TID0 (thread 0 is main thread which does not do real processing)
-    examine_thread_id = 1
-    while True:
-        insts_modified = identifyInstsInOneThread(dyntrace_file, examine_thread_id)
-        if not insts_modified:
-            break
-        examine_thread_id += 1
+            examined_threads.add(thread_id)
+            last_inst[thread_id] = inst
+    finally:
+        trace.close()
 
     assert(len(insts) > 1)
     if DUMPINFO:
-        print("[examined %d threads]" % (examine_thread_id-1))
+        print("[examined %d threads]" % len(examined_threads))
         print("insts = %s" % insts)
 
 
+def packInsts():
+    # sample from flat arrays instead of dict of lists, then drop the dict
+    global insts
+
+    for (inst_addr, (invoc, reg_name, next_addr)) in insts.items():
+        inst_invocs.append(invoc)
+        # names from trace are bytes, gdb scripts are built from str
+        inst_regs.append(reg_name if isinstance(reg_name, str) else reg_name.decode())
+        inst_next_addrs.append(0 if next_addr == "DUMMY" else int(next_addr, 16))
+    insts = {}
+
+
+def instsCacheFile(dyntrace_file):
+    # cached table is only valid for this very trace and set of supported regs
+    st = os.stat(dyntrace_file)
+    return "%s.insts.%d.%d%s.pkl" % (dyntrace_file, st.st_size, int(st.st_mtime),
+                                      ".rflags" if b"rflags" in SUPPORTED_GP_REGS else "")
+
+
+def loadInsts(dyntrace_file):
+    # parsing the trace is slow, reuse the table of previous campaigns if any
+    global inst_invocs, inst_regs, inst_next_addrs
+
+    cachefile = instsCacheFile(dyntrace_file)
+    if os.path.exists(cachefile):
+        try:
+            with open(cachefile, "rb") as f:
+                (inst_invocs, inst_regs, inst_next_addrs) = pickle.load(f)
+            if DUMPINFO:
+                print("[loaded %d insts from %s]" % (len(inst_invocs), cachefile))
+            return
+        except Exception:
+            # broken or written by other python version, parse again
+            pass
+
+    identifyInsts(dyntrace_file)
+    packInsts()
+
+    try:
+        with open(cachefile, "wb") as f:
+            pickle.dump((inst_invocs, inst_regs, inst_next_addrs),
+                        f, pickle.HIGHEST_PROTOCOL)
+    except IOError:
+        # e.g., trace lies in read-only dir, just do not cache
+        pass
+
+
 # ---------------------- WRITE GDB SCRIPT FOR INJECTION ---------------------- #
 def writeScript(scriptfile, instaddr, numinvoc, regname, mask):
-    if instaddr == "DUMMY":
+    if instaddr == 0:
         return
 
-    with open(scriptfile, "w") as f:
-        f.write("target remote :%d\n" % DEBUGPORT)
-        f.write("tb *%s\n" % instaddr)          # set breakpoint on instr address
-        f.write("ignore 1 %d\n" % (numinvoc-1)) # ignore this breakpoint x times
-        f.write("commands 1\n")
-
-        # inject fault in output register
-        if regname.startswith("xmm"):
-            f.write("  p $%s.uint128\n" % regname)
-            f.write("  set $%s.v2_int64[0] = $%s.v2_int64[0] ^ %d\n" % (regname, regname, mask))
-            f.write("  p $%s.uint128\n" % regname)
-        elif regname.startswith("ymm"):
-            f.write("  p $%s.v2_int128\n" % regname)
-            f.write("  set $%s.v4_int64[0] = $%s.v4_int64[0] ^ %d\n" % (regname, regname, mask))
-            f.write("  p $%s.v2_int128\n" % regname)
-        elif regname.startswith("rflags"):
-            f.write("  p $eflags\n")
-            f.write("  set $eflags = $eflags ^ 0xC5\n") # flip CF, PF, ZF, and SF
-            f.write("  p $eflags\n")
-        else:
-            f.write("  p $%s\n" % regname)
-            f.write("  set $%s = (long long) $%s ^ %d\n" % (regname, regname, mask))
-            f.write("  p $%s\n" % regname)
+    # inject fault in output register
+    inject = INJECT_TEMPLATES.get(regname[:3], INJECT_GP)
 
-        f.write("  continue\n")
-        f.write("end\n")
-        f.write("continue\n")
-        f.write("p \"Going to detach...\"\n")
-        f.write("detach\n")
+    script = GDBSCRIPT_TEMPLATE % {"port":   DEBUGPORT,
+                                   "addr":   instaddr,
+                                   "ignore": numinvoc - 1,
+                                   "inject": inject % {"reg": regname, "mask": mask}}
 
-        f.close()
+    # whole script in one write
+    fd = os.open(scriptfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, script.encode())
+    finally:
+        os.close(fd)
 
 
 # --------------------------- INJECT RANDOM FAULT ---------------------------- #
-def injectFault(rtmmode, index, program, args):
+def drawFaults(rng):
+    # faults for all tries of one injection: (index into inst_* arrays,
+    # invocation of instr to inject into, mask to xor output register with)
+    faults = []
     for trynum in range(0, MAXTRIES):
-        instaddr = random.choice(insts.keys())
+        i = rng.randrange(len(inst_invocs))
+        numinvoc = rng.randint(1, inst_invocs[i])
+        mask = rng.randint(1, 255)
+        faults.append((i, numinvoc, mask))
+    return faults
+
 
-        totalinvoc = insts[instaddr][0]
-        numinvoc   = random.randint(1, totalinvoc)
-        regname    = insts[instaddr][1]
-        injectinstaddr = insts[instaddr][2]
-        mask       = random.randint(1, 255)
+def injectFault(rtmmode, index, program, args, faults):
+    # SDE is started anew for every try: the program must run from a clean
+    # state until exit, and SDE cannot restart it under the same debugger,
+    # so only the commands are prepared once per injection
+    scriptfile = "%s/%s_%06d.%s" % (LOGDIR, program, index, GDBSCRIPT)
+
+    sde_run = "%s -rtm-mode %s -debug -debug-port %d -- %s %s" % \
+        (SDE, rtmmode, DEBUGPORT, program, args)
+
+    # both processes run inside the workdir, so pass script by full path
+    gdb_run = "%s --batch --command=%s --args %s %s" % \
+        (GDB, os.path.abspath(scriptfile), program, args)
+
+    for (i, numinvoc, mask) in faults:
+        regname    = inst_regs[i]
+        injectinstaddr = inst_next_addrs[i]
 
         # restrict only to first 300 invocations, otherwise too slow
         numinvoc   = numinvoc % 300
 
-        scriptfile = "%s/%s_%06d.%s" % (LOGDIR, program, index, GDBSCRIPT)
         writeScript(scriptfile, injectinstaddr, numinvoc, regname, mask)
 
-        sde_run = "%s -rtm-mode %s -debug -debug-port %d -- %s %s" % \
-            (SDE, rtmmode, DEBUGPORT, program, args)
-
-        gdb_run = "%s --batch --command=%s --args %s %s" % \
-            (GDB, scriptfile, program, args)
-
         # before we run, remove tmp folder
-        shutil.rmtree('tmp', True)
-
-        retcode1, stdout1, stderr1, retcode2, stdout2, stderr2 = run2(sde_run, gdb_run)
+        removeTmpDir()
+
+        # unsorted text output is compared with ref while program runs
+        matcher = None
+        if binary_output == "" and not SORTOUTPUT:
+            if ERROROUTPUT:
+                # skip line of TSX info if there is one
+                matcher = OutputMatcher(ref_output, 1, b"TSX log collection started")
+            else:
+                matcher = OutputMatcher(ref_output, 3) # skip 3 lines of SDE info
 
-        sde_log = "[return code: %d]\n\n---------- stderr ----------\n%s\n\n---------- stdout ----------\n%s" % \
-                    (retcode1, stderr1, stdout1)
-        gdb_log = "[return code: %d]\n\n---------- stderr ----------\n%s\n\n---------- stdout ----------\n%s" % \
-                    (retcode2, stderr2, stdout2)
+        retcode1, stdout1, stderr1, retcode2, stdout2, stderr2 = \
+            run2(sde_run, gdb_run, cwd = WORKDIR, matcher = matcher, match_stderr = ERROROUTPUT)
 
         res = "DUMMY"
         if retcode1 == -1 or retcode2 == -1:
@@ -311,34 +661,43 @@ def injectFault(rtmmode, index, program, args):
             # program failed
             if retcode1 == 2:   res = "SWIFT"
             elif (retcode1 == 255 and
-                  stdout1.startswith("E: Unable to create debugger connection")):
+                  stdout1.startswith(b"E: Unable to create debugger connection")):
                 res = "GDB"
             elif retcode1 == 1:
-                if "SDE PINTOOL EXITNOW ERROR" in stderr1:    res = "SDE"
-                elif "unaligned memory reference" in stderr1: res = "OS"
+                if b"SDE PINTOOL EXITNOW ERROR" in stderr1:    res = "SDE"
+                elif b"unaligned memory reference" in stderr1: res = "OS"
                 else:                                         res = "PROG"
             else:               res = "OS"
         else:
             # both program and gdb exited nicely -- maybe it's a SDC?
             if binary_output != "":
                 # binary, calc md5 of binary_output and compare with ref
-                prog_output = hashlib.md5(open(binary_output, 'rb').read()).hexdigest()
+                prog_output = md5File(os.path.join(WORKDIR, binary_output))
+                masked = (prog_output == ref_output)
+            elif matcher is not None:
+                # normal text, already compared with ref while it was read
+                masked = matcher.masked()
             else:
-                # normal text, remove header, sort if needed and compare with ref
+                # sorted text, skip header, sort and compare with ref
                 if ERROROUTPUT:
-                    tmplist = stderr1.splitlines(True)
-                    if len(tmplist) > 0 and "TSX log collection started" in tmplist[0]:
-                        # remove line of TSX info
-                        tmplist = tmplist[1:]
+                    prog_output = stderr1
+                    offset = skipLines(prog_output, 1)
+                    if b"TSX log collection started" not in prog_output[:offset]:
+                        # no line of TSX info to skip
+                        offset = 0
                 else:
-                    tmplist = stdout1.splitlines(True)
-                    tmplist = tmplist[3:] # remove 3 lines of SDE info
-                if SORTOUTPUT:
+                    prog_output = stdout1
+                    offset = skipLines(prog_output, 3) # skip 3 lines of SDE info
+                # sorting keeps the length, differing outputs are SDCs
+                # without sorting them
+                masked = (len(prog_output) - offset == len(ref_output))
+                if masked:
+                    tmplist = prog_output[offset:].splitlines(True)
                     tmplist.sort()
-                prog_output = ''.join(tmplist)
+                    masked = (b''.join(tmplist) == ref_output)
 
-            if prog_output == ref_output: res = "MASKED"
-            else:                         res = "SDC"
+            if masked: res = "MASKED"
+            else:      res = "SDC"
 
         if res == "SDE" or res == "GDB":
             # we want to silently ignore SDE & GDB failures and retry FI again
@@ -347,20 +706,113 @@ def injectFault(rtmmode, index, program, args):
         # ----- log everything
         sdelogfile = "%s/%s_%06d.%s" % (LOGDIR, program, index, SDELOG)
         gdblogfile = "%s/%s_%06d.%s" % (LOGDIR, program, index, GDBLOG)
-        fulllogfile = "%s/%s" % (LOGDIR, FULLLOG)
-        with open(sdelogfile, "w") as f:
-            f.write(sde_log)
-            f.close()
-        with open(gdblogfile, "w") as f:
-            f.write(gdb_log)
-            f.close()
-        with open(fulllogfile, "a") as f:
-            f.write("%06d   %6s\n" % (index, res))
-            f.close()
+        writeRunLog(sdelogfile, retcode1, stderr1, stdout1)
+        writeRunLog(gdblogfile, retcode2, stderr2, stdout2)
+        with log_lock:
+            fulllog.write("%06d   %6s\n" % (index, res))
         # it was a succesfull fault injection, stop trying
         return
 
 
+def removeTmpDir():
+    # rename is instant, the (possibly slow) deletion happens in background
+    # while the next run already uses a fresh tmp folder
+    global num_removed_tmps
+
+    tmpdir = os.path.join(WORKDIR, "tmp")
+    if not os.path.lexists(tmpdir):
+        return
+
+    trashdir = "%s.removed_%d" % (tmpdir, num_removed_tmps)
+    num_removed_tmps += 1
+    try:
+        os.rename(tmpdir, trashdir)
+    except OSError:
+        shutil.rmtree(tmpdir, True)
+        return
+
+    # a process, not a thread: forking the program under test (preexec_fn)
+    # is not safe while other threads run; finished removers are reaped
+    # here, leftovers of unfinished deletions go away with the workdir
+    removers[:] = [p for p in removers if p.poll() is None]
+    removers.append(subprocess.Popen(["rm", "-rf", trashdir]))
+
+
+# ------------------------- PARALLEL FAULT INJECTION ------------------------- #
+def workdirName(worker_id):
+    return "%s/work_%d" % (LOGDIR, worker_id)
+
+
+def isSharedPath(path):
+    # path (normalized) outside current dir is the same for all workers
+    return os.path.isabs(path) or path.split("/")[0] == ".."
+
+
+def mirrorDir(srcdir, dstdir, private):
+    # symlink all entries of srcdir into new dir dstdir, except private paths
+    # (relative to srcdir): these are left out, and dirs on the way to them
+    # are real dirs mirroring their other entries in turn
+    os.makedirs(dstdir)
+    for entry in os.listdir(srcdir):
+        if entry in private:
+            continue
+        src = os.path.join(srcdir, entry)
+        inner = [p.split("/", 1)[1] for p in private if p.startswith(entry + "/")]
+        if inner and os.path.isdir(src):
+            mirrorDir(src, os.path.join(dstdir, entry), inner)
+        else:
+            os.symlink(os.path.abspath(src), os.path.join(dstdir, entry))
+
+
+def createWorkdir(workdir):
+    # mirror current dir, so that program finds its inputs, but keep outputs
+    # (binary output, tmp) private to the worker
+    private = ["tmp", os.path.normpath(LOGDIR)]
+    if binary_output != "" and not isSharedPath(binary_output):
+        private.append(binary_output)
+    mirrorDir(".", workdir, private)
+
+    if binary_output != "" and not isSharedPath(binary_output):
+        # dir of binary output may be created only by the program itself
+        outdir = os.path.join(workdir, os.path.dirname(binary_output))
+        try:
+            os.makedirs(outdir)
+        except OSError:
+            if not os.path.isdir(outdir):
+                raise
+
+
+def isAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def initWorker(lock, owners):
+    global DEBUGPORT, WORKDIR, log_lock
+
+    # take the first id not owned by a live worker (pid 0 is not started
+    # yet): a worker replacing a dead one gets its id, so that ids (and with
+    # them workdirs and ports) stay within 0 .. JOBS-1
+    with owners.get_lock():
+        worker_id = [i for i in range(0, JOBS)
+                     if owners[i] == 0 or not isAlive(owners[i])][0]
+        owners[worker_id] = os.getpid()
+
+    # each worker talks to its own SDE instance; stepping by number of
+    # workers keeps ports of workers apart when some of them are taken
+    DEBUGPORT = freePort(DEBUGPORT + worker_id, JOBS)
+    WORKDIR = workdirName(worker_id)
+    log_lock = lock
+
+
+def injectFaultTask(task):
+    (rtmmode, index, program, args, faults) = task
+    injectFault(rtmmode, index, program, args, faults)
+
+
 # ------------------------------- MAIN FUNCTION ------------------------------ #
 rtmmodes = ['full', 'nop']
 
@@ -404,8 +856,25 @@ def get_compand_line_arguments():
     parser.add_argument('-f', '--injecteflags',
                         action="store_true",
                         help='Inject into EFLAGS register')
-
-    return parser.parse_args()
+    parser.add_argument('-S', '--seed',
+                        type=int,
+                        default=None,
+                        help='Seed for random faults (to repeat a campaign)')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=JOBS,
+                        help='Number of fault injections run in parallel')
+
+    args = parser.parse_args()
+    if args.jobs > 1 and args.binaryoutput != "" \
+            and isSharedPath(os.path.normpath(args.binaryoutput)):
+        # workers would overwrite each other's output
+        parser.error("binary output must be inside current dir with -j > 1")
+    if args.jobs > 1 and any(os.path.normpath(path).split("/")[0] == ".."
+                             for path in [args.program] + args.arguments.split()):
+        # workers run in workdirs one level deeper than log dir
+        parser.error("program and arguments must not refer to \"..\" with -j > 1")
+    return args
 
 
 def main():
@@ -414,32 +883,34 @@ def main():
 
     args = get_compand_line_arguments()
 
-    global SORTOUTPUT, ERROROUTPUT, FULLLOG, LOGDIR, SUPPORTED_GP_REGS, DEBUGPORT, binary_output, ref_output
+    global SORTOUTPUT, ERROROUTPUT, FULLLOG, LOGDIR, SUPPORTED_GP_REGS, DEBUGPORT, JOBS, binary_output, ref_output, fulllog, log_lock
 
     # set globals to values from command line or keep default values
     SORTOUTPUT = True if args.sortoutput else SORTOUTPUT
     ERROROUTPUT = True if args.erroroutput else ERROROUTPUT
     LOGDIR = args.logdir if args.logdir != "" else LOGDIR
     DEBUGPORT = int(args.debugport) if args.debugport != "" else DEBUGPORT
-    binary_output = args.binaryoutput if args.binaryoutput != "" else binary_output
+    JOBS = max(1, args.jobs)
+    binary_output = os.path.normpath(args.binaryoutput) if args.binaryoutput != "" else binary_output
 
     FULLLOG = os.path.basename(args.program) + '.log'
 
     if args.injecteflags:
-        SUPPORTED_GP_REGS.append('rflags')  # look for rflags in the trace
+        SUPPORTED_GP_REGS |= frozenset([b'rflags'])  # look for rflags in the trace
 
     if binary_output != "":
         # ref output as binary, calculate md5 sum
-        ref_output = hashlib.md5(open(args.refoutput, 'rb').read()).hexdigest()
+        ref_output = md5File(args.refoutput)
     else:
         # ref output as normal text, read all lines and sort if needed
-        with open(args.refoutput, "r") as f:
+        # (as bytes, to compare with raw output of the program)
+        with open(args.refoutput, "rb") as f:
             ref_output = f.read()
             if SORTOUTPUT:
                 tmplist = ref_output.splitlines(True)
                 tmplist.sort()
-                ref_output = ''.join(tmplist)
-    assert(ref_output != "")
+                ref_output = b''.join(tmplist)
+    assert(len(ref_output) > 0)
 
     try:
         os.makedirs("%s/%s" % (LOGDIR, os.path.dirname(args.program)))
@@ -447,10 +918,48 @@ def main():
         pass
 #        assert(0)
 
-    initLog(args.refoutput, args.dyntrace, args.rtmmode, args.program, args.arguments)
-    identifyInsts(args.dyntrace)
-    for i in range(0, LIMIT):
-        injectFault(args.rtmmode, i, args.program, args.arguments)
+    # all faults are drawn here up front, so that a seed fully determines the
+    # campaign no matter how injections are spread over workers
+    seed = args.seed if args.seed is not None else random.randrange(2**32)
+    rng = random.Random(seed)
+
+    initLog(args.refoutput, args.dyntrace, args.rtmmode, args.program, args.arguments, seed)
+    # line-buffered, so nothing is pending in the buffer when workers fork
+    fulllog = open("%s/%s" % (LOGDIR, FULLLOG), "a", 1)
+    loadInsts(args.dyntrace)
+
+    tasks = [(args.rtmmode, i, args.program, args.arguments, drawFaults(rng))
+             for i in range(0, LIMIT)]
+
+    if JOBS == 1:
+        # nothing runs in parallel, inject right here in current dir
+        DEBUGPORT = freePort(DEBUGPORT, 1)
+        log_lock = multiprocessing.Lock()
+        for task in tasks:
+            injectFaultTask(task)
+        fulllog.close()
+        return
+
+    workdirs = [workdirName(w) for w in range(0, JOBS)]
+    for workdir in workdirs:
+        shutil.rmtree(workdir, True)
+        createWorkdir(workdir)
+
+    # workers are forked and inherit globals (inst_*, ref_output, ...) from
+    # here; fork is not the default everywhere in python 3 (>= 3.14 on Linux)
+    if hasattr(multiprocessing, "get_context"):
+        mp = multiprocessing.get_context("fork")
+    else:
+        mp = multiprocessing
+    pool = mp.Pool(JOBS, initWorker, (mp.Lock(), mp.Array('i', JOBS)))
+    for _ in pool.imap_unordered(injectFaultTask, tasks):
+        pass
+    pool.close()
+    pool.join()
+    fulllog.close()
+
+    for workdir in workdirs:
+        shutil.rmtree(workdir, True)
 
 
 if __name__ == "__main__":